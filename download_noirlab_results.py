@@ -2,13 +2,171 @@
 
 from getpass import getpass
 from dl import authClient, storeClient
+from dl.__version__ import __version__ as DL_CLIENT_VERSION
+from dl.Util import split_auth_token
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import argparse
+import mmap
 import os
+import re
+import shutil
 import sys
 import warnings
+import requests
 from tqdm import tqdm
 
-def download_all_results(vos_dir, local_dir, log_file=None):
+# Shared HTTPS session so every download reuses pooled keep-alive connections
+# instead of paying a fresh TCP + TLS handshake per file
+_SESSION = requests.Session()
+
+def _mount_https_pool(pool_size):
+    """(Re)mount the session's HTTPS adapter with room for pool_size concurrent connections per host."""
+    _SESSION.mount("https://", HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.2)
+    ))
+
+_mount_https_pool(32)
+
+# (connect, read) timeouts in seconds, so a stalled transfer fails instead of blocking a worker forever
+_TIMEOUT = (10, 120)
+
+# Matches the .adql filename at the start of each query log line
+_LOG_ENTRY_RE = re.compile(rb"(?m)^[ \t]*(\S+)\.adql(?=\s|$)")
+
+# Where a valid auth token is cached between runs (readable only by the user)
+TOKEN_FILE = os.path.expanduser("~/.noirlab_token")
+
+def get_token():
+    """
+    Return a valid NOIRLab authentication token.
+    
+    Reuses the token from the NOIRLAB_TOKEN environment variable or from
+    TOKEN_FILE if it is still valid. Otherwise prompts for credentials,
+    logs in, and caches the new token in TOKEN_FILE.
+    """
+    cached_token = None
+    try:
+        if os.path.exists(TOKEN_FILE):
+            with open(TOKEN_FILE, "r") as f:
+                cached_token = f.read().strip()
+    except OSError as e:
+        # The cache is only a shortcut - fall back to logging in
+        print(f"[WARNING] Could not read saved token from '{TOKEN_FILE}': {e}")
+    
+    for token in (os.environ.get("NOIRLAB_TOKEN"), cached_token):
+        if token and authClient.isValidToken(token):
+            print("[OK] Reusing saved NOIRLab token.")
+            return token
+    
+    username = input("Enter NOIRLab username: ")
+    password = getpass("Enter NOIRLab password: ")
+    
+    token = authClient.login(username, password)
+    if not authClient.isValidToken(token):
+        raise Exception("[ERROR] Token is not valid. Please check your username/password.")
+    
+    print("[OK] Authenticated successfully.")
+    try:
+        fd = os.open(TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(token)
+        os.chmod(TOKEN_FILE, 0o600)
+    except OSError as e:
+        # e.g. read-only or missing home directory - carry on with the token we have
+        print(f"[WARNING] Could not save token to '{TOKEN_FILE}': {e}")
+    return token
+
+def download_file(token, vos_file, local_path):
+    """
+    Download a single file from VOS over the shared HTTPS session.
+    
+    Follows the same protocol as storeClient.get(): ask the storage manager
+    for a transfer URL, then stream the file contents from that URL. The
+    request carries the same auth, user and client-version headers; the
+    X-DL-OriginIP/X-DL-OriginHost headers are left out on purpose, since
+    storeClient only exposes them through private attributes.
+    
+    Data is streamed into "<local_path>.part" and renamed on completion. The
+    file's ETag (or Last-Modified) is saved next to it, so if a .part file is
+    left over from an interrupted run the download resumes from its end with
+    an HTTP Range + If-Range request (the body is requested without content
+    encoding, so Range offsets match the bytes already on disk). If the remote file has changed since,
+    it is downloaded again from the start.
+    
+    Args:
+        token: NOIRLab authentication token
+        vos_file: Remote file URI (e.g. vos://cool-lamps-fullsky/file.csv)
+        local_path: Local path to write the file to
+    """
+    user = (split_auth_token(token.strip()) or [""])[0]
+    headers = {
+        "X-DL-ClientVersion": DL_CLIENT_VERSION,
+        "X-DL-User": user,
+        "X-DL-AuthToken": token
+    }
+    res = _SESSION.get(
+        f"{storeClient.get_svc_url()}/get",
+        params={"name": vos_file},
+        headers=headers,
+        timeout=_TIMEOUT
+    )
+    res.raise_for_status()
+    transfer_url = res.text.strip()
+    if not transfer_url.startswith("http"):
+        raise Exception(transfer_url)
+    
+    part_path = local_path + ".part"
+    validator_path = part_path + ".validator"
+    
+    # Only resume when we know which version of the file the .part belongs to
+    existing, validator = 0, None
+    if os.path.exists(part_path) and os.path.exists(validator_path):
+        existing = os.path.getsize(part_path)
+        with open(validator_path, "r") as f:
+            validator = f.read().strip() or None
+    # Ask for the raw bytes: Range offsets refer to the encoded body, so a
+    # compressed response would not line up with the decoded .part size
+    transfer_headers = {"Accept-Encoding": "identity"}
+    resume_headers = {"Range": f"bytes={existing}-", "If-Range": validator} if existing and validator else {}
+    
+    r = _SESSION.get(transfer_url, stream=True, headers={**transfer_headers, **resume_headers},
+                     timeout=_TIMEOUT)
+    # Append only if the server sends exactly the bytes that continue the .part file
+    # (a changed file comes back as a full 200 because of If-Range)
+    resumed = (
+        bool(resume_headers)
+        and r.status_code == 206
+        and r.headers.get("Content-Range", "").startswith(f"bytes {existing}-")
+    )
+    if r.status_code in (206, 416) and not resumed:
+        # Partial file cannot be continued - fetch it all again
+        r.close()
+        r = _SESSION.get(transfer_url, stream=True, headers=transfer_headers, timeout=_TIMEOUT)
+    with r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        if not resumed:
+            # Remember the version being downloaded so an interrupted transfer can resume safely
+            etag = r.headers.get("ETag", "")
+            validator = etag if etag and not etag.startswith("W/") else r.headers.get("Last-Modified")
+            if r.headers.get("Content-Encoding", "identity") != "identity":
+                validator = None  # Server compressed anyway - byte offsets won't match, never resume
+            if validator:
+                with open(validator_path, "w") as f:
+                    f.write(validator)
+            elif os.path.exists(validator_path):
+                os.remove(validator_path)
+        with open(part_path, "ab" if resumed else "wb") as f:
+            shutil.copyfileobj(r.raw, f)
+    os.replace(part_path, local_path)
+    if os.path.exists(validator_path):
+        os.remove(validator_path)
+
+def download_all_results(vos_dir, local_dir, log_file=None, workers=None):
     """
     Download query results from NOIRLab Virtual Storage (VOS).
     
@@ -21,22 +179,17 @@ def download_all_results(vos_dir, local_dir, log_file=None):
         vos_dir: Remote VOS directory name
         local_dir: Local directory to save files
         log_file: (Optional) Query log file to read. If None, downloads all files in VOS.
+        workers: (Optional) Number of parallel downloads. Defaults to min(32, number of files).
     """
     
     # Authenticate
     print("[INFO] Authenticating with NOIRLab...")
-    username = input("Enter NOIRLab username: ")
-    password = getpass("Enter NOIRLab password: ")
-    
-    token = authClient.login(username, password)
-    if not authClient.isValidToken(token):
-        raise Exception("[ERROR] Token is not valid. Please check your username/password.")
-    print("[OK] Authenticated successfully.")
+    token = get_token()
     
     # Check VOS directory
     vos_path = f'vos://{vos_dir}'
     print(f"[INFO] Checking VOS directory: {vos_path}")
-    if not storeClient.access(vos_path):
+    if not storeClient.access(vos_path, token=token):
         raise Exception(f"[ERROR] Remote VOS directory '{vos_path}' does not exist or is not accessible.")
     print(f"[OK] VOS directory accessible.")
     
@@ -47,12 +200,10 @@ def download_all_results(vos_dir, local_dir, log_file=None):
             raise FileNotFoundError(f"[ERROR] Query log file '{log_file}' not found.")
         
         csv_files = []
-        with open(log_file, "r") as log:
-            for line in log:
-                parts = line.strip().split()
-                if parts and parts[0].endswith(".adql"):
-                    csv_file = parts[0].replace(".adql", ".csv")
-                    csv_files.append(csv_file)
+        if os.path.getsize(log_file) > 0:
+            with open(log_file, "rb") as log, mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # dict.fromkeys drops queries logged more than once, keeping log order
+                csv_files = list(dict.fromkeys(m.group(1).decode() + ".csv" for m in _LOG_ENTRY_RE.finditer(mm)))
         
         if not csv_files:
             print("[WARNING] No completed queries found in query log.")
@@ -61,7 +212,7 @@ def download_all_results(vos_dir, local_dir, log_file=None):
     else:
         # List all .csv files in VOS directory
         print("[INFO] Listing all files in VOS directory...")
-        files_str = storeClient.ls(vos_path)
+        files_str = storeClient.ls(vos_path, token=token)
         # storeClient.ls() returns comma-separated string, not a list
         files = [f.strip() for f in files_str.split(',') if f.strip()]
         csv_files = [f for f in files if f.endswith(".csv")]
@@ -75,25 +226,69 @@ def download_all_results(vos_dir, local_dir, log_file=None):
     # Create local directory if needed
     os.makedirs(local_dir, exist_ok=True)
     
-    # Download each CSV file
+    # Skip files already downloaded by a previous run (incomplete downloads only exist as .part files)
+    to_fetch = []
+    for filename in csv_files:
+        local_path = os.path.join(local_dir, filename)
+        if not (os.path.exists(local_path) and os.path.getsize(local_path) > 0):
+            to_fetch.append(filename)
+    if len(to_fetch) < len(csv_files):
+        print(f"[INFO] Skipping {len(csv_files) - len(to_fetch)} files already present in '{local_dir}'")
+    if not to_fetch:
+        print("[OK] All files already downloaded.")
+        return
+    
+    # Download CSV files in parallel (each transfer is dominated by network latency)
+    if workers is None:
+        workers = min(32, len(to_fetch))
+    if workers < 1:
+        raise ValueError(f"[ERROR] workers must be at least 1, got {workers}.")
+    # One pooled keep-alive connection per worker, so none are discarded and re-opened
+    _mount_https_pool(workers)
     failed = []
-    print(f"[RUN] Downloading {len(csv_files)} files...")
-    for filename in tqdm(csv_files, desc="Progress", unit="file", ncols=80):
-        try:
-            local_path = os.path.join(local_dir, filename)
-            storeClient.get(fr=f"{vos_path}/{filename}", to=local_path)
-            
-        except Exception as e:
-            failed.append((filename, str(e)))
+    print(f"[RUN] Downloading {len(to_fetch)} files with {workers} workers...")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                download_file,
+                token,
+                f"{vos_path}/{filename}",
+                os.path.join(local_dir, filename)
+            ): filename
+            for filename in to_fetch
+        }
+        # Throttle redraws: with many workers, completions arrive faster than the terminal needs updating
+        progress = tqdm(
+            as_completed(futures),
+            total=len(futures),
+            desc="Progress",
+            unit="file",
+            ncols=80,
+            mininterval=0.5,
+            miniters=max(1, len(futures) // 200)
+        )
+        for future in progress:
+            filename = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failed.append((filename, str(e)))
     
     # Summary
     print(f"[OK] Download complete.")
-    print(f"[INFO] Successfully downloaded: {len(csv_files) - len(failed)}/{len(csv_files)} files")
+    print(f"[INFO] Successfully downloaded: {len(to_fetch) - len(failed)}/{len(to_fetch)} files")
     if failed:
         print(f"[WARNING] Failed to download {len(failed)} files:")
         for filename, error in failed:
             print(f"  - {filename}: {error}")
 
+def positive_int(value):
+    """argparse type for options that must be an integer >= 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Download NOIRLab query results from Virtual Object Store (VOS)."
@@ -113,10 +308,17 @@ if __name__ == "__main__":
         default=None,
         help="Query log file to read. If not provided, downloads all CSV files in VOS directory."
     )
+    parser.add_argument(
+        "--workers",
+        type=positive_int,
+        default=None,
+        help="Number of parallel downloads (default: min(32, number of files))"
+    )
     
     args = parser.parse_args()
     download_all_results(
         vos_dir=args.vos_dir,
         local_dir=args.local_dir,
-        log_file=args.log_file
+        log_file=args.log_file,
+        workers=args.workers
     )
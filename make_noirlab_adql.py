@@ -1,9 +1,10 @@
 # make_noirlab_adql.py
 
 import os
+import functools
+import math
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from astropy.coordinates import SkyCoord
-import astropy.units as u
 
 # ADQL query parameters
 RA_MIN_BASE = 0
@@ -17,61 +18,135 @@ GALACTIC_LAT = None  # Set to "north", "south", or None
 MW_DISK_LAT1 = 15.0   # Northern boundary of the Milky Way (degrees) - DO NOT CHANGE
 MW_DISK_LAT2 = -15.0  # Southern boundary of the Milky Way (degrees) - DO NOT CHANGE
 
-ADQL_TEMPLATE = """
-SELECT ra, dec, dered_mag_g, dered_mag_r, dered_mag_i, dered_mag_z, type, snr_g, snr_r, snr_i, snr_z, 
-    maskbits, mag_w1, mag_w2, snr_w1, snr_w2, ebv, fitbits, parallax, parallax_ivar, 
-    psfdepth_g, psfdepth_r, psfdepth_i, psfdepth_z, psfdepth_w1, psfdepth_w2, 
-    psfsize_g, psfsize_r, psfsize_i, psfsize_z
-FROM ls_dr10.tractor
-WHERE ra BETWEEN {ra_min} AND {ra_max}
-  AND dec BETWEEN {dec_min} AND {dec_max}
-  AND (snr_z > 1.5 OR snr_i > 1.5)
-"""
+def build_adql_query(ra_min, ra_max, dec_min, dec_max):
+    """Build the ADQL query for one RA/Dec region."""
+    return (
+        "SELECT ra, dec, dered_mag_g, dered_mag_r, dered_mag_i, dered_mag_z, type, snr_g, snr_r, snr_i, snr_z, \n"
+        "    maskbits, mag_w1, mag_w2, snr_w1, snr_w2, ebv, fitbits, parallax, parallax_ivar, \n"
+        "    psfdepth_g, psfdepth_r, psfdepth_i, psfdepth_z, psfdepth_w1, psfdepth_w2, \n"
+        "    psfsize_g, psfsize_r, psfsize_i, psfsize_z\n"
+        "FROM ls_dr10.tractor\n"
+        f"WHERE ra BETWEEN {ra_min} AND {ra_max}\n"
+        f"  AND dec BETWEEN {dec_min} AND {dec_max}\n"
+        "  AND (snr_z > 1.5 OR snr_i > 1.5)\n"
+    )
+
+# ICRS -> Galactic rotation matrix (Hipparcos catalogue, ESA 1997); its transpose maps Galactic -> ICRS
+_M_EQ2GAL = np.array([
+    [-0.0548755604162154, -0.8734370902348850, -0.4838350155487132],
+    [+0.4941094278755837, -0.4448296299600112, +0.7469822444972189],
+    [-0.8676661490190047, -0.1980763734312015, +0.4559837761750669],
+])
+_M_GAL2EQ = _M_EQ2GAL.T
+# North Galactic pole as an equatorial unit vector (third row of _M_EQ2GAL), as plain floats
+_NGP_X, _NGP_Y, _NGP_Z = _M_EQ2GAL[2].tolist()
+
+def _to_cartesian(lon_deg, lat_deg):
+    """Convert spherical coordinates (degrees) to unit vectors of shape (3, ...)."""
+    lon = np.deg2rad(np.asarray(lon_deg, dtype=float))
+    lat = np.deg2rad(np.asarray(lat_deg, dtype=float))
+    cos_lat = np.cos(lat)
+    return np.array([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
 
 def galactic_to_equatorial(l_deg, b_deg):
     """Convert Galactic to Equatorial coordinates."""
-    gal = SkyCoord(l=np.asarray(l_deg) * u.deg, b=np.asarray(b_deg) * u.deg, frame="galactic")
-    eq = gal.icrs
-    return eq.ra.deg, eq.dec.deg
+    x, y, z = _M_GAL2EQ @ _to_cartesian(l_deg, b_deg)
+    ra = np.rad2deg(np.arctan2(y, x)) % 360.0
+    dec = np.rad2deg(np.arcsin(np.clip(z, -1.0, 1.0)))
+    return ra, dec
 
 def icrs_to_galactic_b(ra_deg, dec_deg):
-    """Convert Equatorial to Galactic latitude."""
-    icrs = SkyCoord(ra=np.asarray(ra_deg) * u.deg, dec=np.asarray(dec_deg) * u.deg, frame="icrs")
-    return icrs.galactic.b.deg
-
-def find_ra_at_dec_crossing(dec_target):
-    """Find RA values where a given Galactic latitude crosses a specific declination.
-    Returns both left and right crossing points if they exist."""
-    l_vals = np.linspace(0.0, 360.0, 10000)
-    if GALACTIC_LAT == "north":
-        b_vals = np.full_like(l_vals, MW_DISK_LAT1, dtype=float)
-    elif GALACTIC_LAT == "south":
-        b_vals = np.full_like(l_vals, MW_DISK_LAT2, dtype=float)
-    else:
-        return None, None
+    """Convert a single Equatorial position to Galactic latitude."""
+    ra, dec = math.radians(ra_deg), math.radians(dec_deg)
+    cos_dec = math.cos(dec)
+    sin_b = _NGP_X * cos_dec * math.cos(ra) + _NGP_Y * cos_dec * math.sin(ra) + _NGP_Z * math.sin(dec)
+    return math.degrees(math.asin(max(-1.0, min(1.0, sin_b))))
+
+# Sample points along the Milky Way disk boundaries (b = MW_DISK_LAT1 / MW_DISK_LAT2)
+_L_VALS = np.linspace(0.0, 360.0, 10000)
+_B_N = np.full_like(_L_VALS, MW_DISK_LAT1)
+_B_S = np.full_like(_L_VALS, MW_DISK_LAT2)
+
+@functools.lru_cache(maxsize=None)
+def _boundary_arc(galactic_lat):
+    """Return the (ra, dec) arrays of the "north" or "south" disk boundary.
+    The boundary does not depend on declination, so it is transformed once
+    on first use and reused for every band."""
+    b_vals = _B_N if galactic_lat == "north" else _B_S
+    ra_deg_line, dec_deg_line = galactic_to_equatorial(_L_VALS, b_vals)
+    # Unwrap RA so interpolating across the 360 -> 0 seam stays on the boundary
+    return np.rad2deg(np.unwrap(np.deg2rad(ra_deg_line))), dec_deg_line
+
+@functools.lru_cache(maxsize=None)
+def _boundary_segments(galactic_lat):
+    """Split the closed "north" or "south" boundary into pieces along which dec is monotonic.
+    Returns a list of (dec, ra) array pairs with dec increasing, ready for np.interp."""
+    ra_deg_line, dec_deg_line = _boundary_arc(galactic_lat)
     
-    ra_deg_line, dec_deg_line = galactic_to_equatorial(l_vals, b_vals)
+    # Restart the loop (l = 0 and l = 360 are the same point) at its southernmost sample,
+    # so the only places dec changes direction are true turning points of the boundary
+    start = np.argmin(dec_deg_line[:-1])
+    ra_loop = np.concatenate([ra_deg_line[start:-1], ra_deg_line[:start+1] + (ra_deg_line[-1] - ra_deg_line[0])])
+    dec_loop = np.concatenate([dec_deg_line[start:-1], dec_deg_line[:start+1]])
+    
+    rising = np.diff(dec_loop) > 0
+    turns = np.flatnonzero(rising[1:] != rising[:-1]) + 1
+    bounds = [0, *turns.tolist(), len(dec_loop) - 1]
+    segments = []
+    for i0, i1 in zip(bounds[:-1], bounds[1:]):
+        dec_seg, ra_seg = dec_loop[i0:i1+1], ra_loop[i0:i1+1]
+        if dec_seg[0] > dec_seg[-1]:
+            dec_seg, ra_seg = dec_seg[::-1], ra_seg[::-1]
+        segments.append((dec_seg, ra_seg))
+    return segments
+
+def boundary_dec_range(galactic_lat):
+    """Return the (lowest, highest) declination reached by the "north" or "south" disk boundary."""
+    segments = _boundary_segments(galactic_lat)
+    return min(dec_seg[0] for dec_seg, _ in segments), max(dec_seg[-1] for dec_seg, _ in segments)
+
+def band_reaches_requested_side(dec_min, dec_max, n_ra=721, n_dec=11):
+    """Check whether any point of an RA/Dec grid sampled over the band lies on the
+    GALACTIC_LAT side of the disk boundary (used to guard against dropping sky)."""
+    ra_grid, dec_grid = np.meshgrid(np.linspace(0.0, 360.0, n_ra), np.linspace(dec_min, dec_max, n_dec))
+    ra_grid, dec_grid = ra_grid.ravel(), dec_grid.ravel()
+    b = np.rad2deg(np.arcsin(np.clip((_M_EQ2GAL @ _to_cartesian(ra_grid, dec_grid))[2], -1.0, 1.0)))
+    if GALACTIC_LAT == "north":
+        return bool(np.any(b > MW_DISK_LAT1))
+    return bool(np.any(b < MW_DISK_LAT2))
+
+def find_ra_at_dec_crossings(dec_targets):
+    """Find RA values where a given Galactic latitude crosses each of the target declinations.
+    Returns two lists (left and right crossing per declination); entries are None
+    where that crossing does not exist."""
+    n_targets = len(dec_targets)
+    if GALACTIC_LAT not in ("north", "south"):
+        return [None] * n_targets, [None] * n_targets
+    dec_targets = np.asarray(dec_targets, dtype=float)
     
-    # Find where the line crosses dec_target
-    y = dec_deg_line - dec_target
+    # Each monotonic piece of the boundary crosses a declination at most once:
+    # binary-search it (np.interp) and interpolate the RA there
     crossings = []
-    for i in range(len(y) - 1):
-        if y[i] * y[i+1] <= 0:  # Sign change indicates crossing
-            if y[i] == y[i+1]:
-                continue
-            t = (-y[i]) / (y[i+1] - y[i])
-            if 0.0 <= t <= 1.0:
-                ra_crossing = ra_deg_line[i] + t * (ra_deg_line[i+1] - ra_deg_line[i])
-                crossings.append(ra_crossing % 360.0)
+    for dec_seg, ra_seg in _boundary_segments(GALACTIC_LAT):
+        inside = (dec_targets >= dec_seg[0]) & (dec_targets <= dec_seg[-1])
+        ra = np.full(n_targets, np.nan)
+        ra[inside] = np.interp(dec_targets[inside], dec_seg, ra_seg) % 360.0
+        crossings.append(ra)
     
-    if len(crossings) >= 2:
-        # Return both boundaries
-        return sorted(crossings)[0], sorted(crossings)[1]
-    elif len(crossings) == 1:
-        # Only one crossing found
-        return crossings[0], None
-    else:
-        return None, None
+    # Sort crossings per declination (missing ones sort last) and keep the first two
+    crossings = np.sort(np.array(crossings + [np.full(n_targets, np.nan)] * 2), axis=0)
+    ra_left, ra_right = crossings[0], crossings[1]
+    
+    return ([None if np.isnan(ra) else ra for ra in ra_left.tolist()],
+            [None if np.isnan(ra) else ra for ra in ra_right.tolist()])
+
+def write_query_file(filepath, data):
+    """Write one encoded ADQL query to disk."""
+    fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
 
 def generate_adql_scripts(output_dir="adql_queries"):
     # Base RA range
@@ -79,16 +154,21 @@ def generate_adql_scripts(output_dir="adql_queries"):
 
     os.makedirs(output_dir, exist_ok=True)
 
-    dec_min = DEC_START
-    count = 0
-    while dec_min < DEC_END:
-        dec_max = round(dec_min + DEC_STEP, 1)
-        
+    # Declination bands, with all edges computed from DEC_START directly (no accumulated rounding drift)
+    n_bands = int(np.ceil((DEC_END - DEC_START) / DEC_STEP - 1e-9))
+    dec_edges = np.round(DEC_START + DEC_STEP * np.arange(n_bands + 1), 1).tolist()
+    dec_bands = list(zip(dec_edges[:-1], dec_edges[1:]))
+
+    # Galactic boundary crossings for all bands in one vectorized search
+    ra_lefts, ra_rights = find_ra_at_dec_crossings([dec_min for dec_min, _ in dec_bands])
+    if GALACTIC_LAT is not None:
+        arc_dec_lo, arc_dec_hi = boundary_dec_range(GALACTIC_LAT)
+
+    batch = []  # (filepath, query bytes) pairs, written in parallel below
+    for (dec_min, dec_max), ra_boundary_left, ra_boundary_right in zip(dec_bands, ra_lefts, ra_rights):
         # Adjust RA limits based on galactic latitude if specified
         ra_min, ra_max = ra_min_base, ra_max_base
         if GALACTIC_LAT is not None:
-            ra_boundary_left, ra_boundary_right = find_ra_at_dec_crossing(dec_min)
-            
             if ra_boundary_left is not None and ra_boundary_right is not None:
                 # Both boundaries found - apply the filter
                 if GALACTIC_LAT == "north":
@@ -99,6 +179,20 @@ def generate_adql_scripts(output_dir="adql_queries"):
                     # Keep RA values outside the boundaries (south of the plane)
                     # For now, just constrain to left side; could also handle right side
                     ra_max = min(ra_max_base, ra_boundary_left)
+            elif dec_max < arc_dec_lo or dec_min > arc_dec_hi:
+                # Whole band lies beyond the boundary's dec range, so it is entirely on one side
+                # Check a test point to see if it's on the requested side of the boundary
+                test_ra = (ra_min_base + ra_max_base) / 2
+                test_b = icrs_to_galactic_b(test_ra, dec_min)
+                
+                if (GALACTIC_LAT == "north" and not test_b > MW_DISK_LAT1) or \
+                        (GALACTIC_LAT == "south" and not test_b < MW_DISK_LAT2):
+                    # Entire band is on the other side of the plane - skip this declination
+                    if band_reaches_requested_side(dec_min, dec_max):
+                        raise RuntimeError(f"[ERROR] Band dec {dec_min} to {dec_max} would be skipped "
+                                           f"but contains galactic {GALACTIC_LAT} sky.")
+                    ra_min, ra_max = ra_min_base, ra_min_base  # Empty range
+                # Otherwise entire band matches filter, keep full range
             elif ra_boundary_left is not None:
                 # Only one boundary found - declination band is entirely on one side
                 # Check a test point to see if it's north or south of the boundary
@@ -114,18 +208,14 @@ def generate_adql_scripts(output_dir="adql_queries"):
                     # Want south but entire band is north - skip this declination
                     ra_min, ra_max = ra_min_base, ra_min_base  # Empty range
                 # Otherwise entire band matches filter, keep full range
+            # Otherwise no crossing at dec_min but the boundary's turning point lies inside
+            # the band - keep the full RA range so the sky past the turning point is covered
         
         # Skip if RA range is empty (entire band excluded by galactic filter)
         if ra_min >= ra_max:
-            dec_min = dec_max
             continue
         
-        query = ADQL_TEMPLATE.format(
-            ra_min=ra_min,
-            ra_max=ra_max,
-            dec_min=dec_min,
-            dec_max=dec_max
-        )
+        query = build_adql_query(ra_min, ra_max, dec_min, dec_max)
         
         # Generate filename with RA range and galactic latitude if applicable
         if GALACTIC_LAT is not None:
@@ -135,12 +225,13 @@ def generate_adql_scripts(output_dir="adql_queries"):
             filename = f"r{ra_min:.2f}_{ra_max:.2f}_d{dec_min:.1f}_{dec_max:.1f}.adql"
         
         filepath = os.path.join(output_dir, filename)
-        with open(filepath, "w") as f:
-            f.write(query.strip() + "\n")
-        count += 1
-        dec_min = dec_max
+        batch.append((filepath, query.encode()))
+
+    # Write all queries in parallel (small-file I/O releases the GIL)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda job: write_query_file(*job), batch))
 
-    print(f"[OK] Saved {count} ADQL scripts to '{output_dir}/'")
+    print(f"[OK] Saved {len(batch)} ADQL scripts to '{output_dir}/'")
 
 # Run
 if __name__ == "__main__":
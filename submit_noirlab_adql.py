@@ -6,6 +6,7 @@ import pyperclip
 import sys
 import platform
 from datetime import datetime
+from pathlib import Path
 
 # Platform-specific imports
 if platform.system() != "Windows":
@@ -63,7 +64,11 @@ def wait_for_key(prompt, valid_keys):
             termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
 
 def paste_next_query_and_log(directory="adql_queries", log_file="query_log.txt"):
-    files = sorted(f for f in os.listdir(directory) if f.endswith(".adql") and not f.startswith("DONE_"))
+    with os.scandir(directory) as entries:
+        files = sorted(
+            e.name for e in entries
+            if e.name.endswith(".adql") and not e.name.startswith("DONE_") and e.is_file()
+        )
     
     if not files:
         print("[OK] No ADQL files to process.")
@@ -71,43 +76,48 @@ def paste_next_query_and_log(directory="adql_queries", log_file="query_log.txt")
 
     print(f"[RUN] Starting to process {len(files)} queries...")
 
-    for next_file in files:
-        filepath = os.path.join(directory, next_file)
-        # Generate CSV base filename from query filename (without .adql extension)
-        base_filename = CSV_OUTPUT_PREFIX + os.path.splitext(next_file)[0]
-
-        # Read and copy query to clipboard
-        with open(filepath, "r") as f:
-            query = f.read()
-        pyperclip.copy(query)
-        print(f"\n[CLIPBOARD] Copied {next_file} to clipboard.")
-
-        # Open browser
-        # webbrowser.open("https://datalab.noirlab.edu/legacy/query.php")
-        webbrowser.open("https://datalab.noirlab.edu/data-explorer")
-        print("[INFO] Opened NOIRLab Data Explorer.")
-        print("[HELP] Paste the query manually into the ADQL field (Ctrl+V / Cmd+V). Then click 'Execute'.")
-
-        # Copy .csv base file name (and directory) to clipboard
-        wait_for_key("[WAIT] Press [space] after you've pasted the query and selected 'Virtual Storage (VOS)' to get your .csv base filename: ", valid_keys=[' '])
-        print("[HELP] Click \"Virtual Storage (VOS)\" in the drop-down to see the \"File Name\" field.")
-        print("[INFO] Filename for CSV export: '{0}'".format(base_filename))
-        pyperclip.copy(base_filename)
-        print("[CLIPBOARD] Copied CSV filename to clipboard.")
-
-        # Submit the query
-        wait_for_key("[WAIT] Press [Enter] after you've submitted the query (hit 'Save to VOS') to submit the query... ", valid_keys=['\r'])
+    # Select the clipboard backend once for the session and call it directly
+    copy_to_clipboard, _ = pyperclip.determine_clipboard()
+
+    query_dir = Path(directory)
+
+    # Keep the log open for the whole session instead of reopening it per query
+    with open(log_file, "a") as log:
+        for next_file in files:
+            query_path = query_dir / next_file
+            # Generate CSV base filename from query filename (without .adql extension)
+            base_filename = CSV_OUTPUT_PREFIX + query_path.stem
+
+            # Read and copy query to clipboard
+            query = query_path.read_text(encoding="utf-8")
+            copy_to_clipboard(query)
+            print(f"\n[CLIPBOARD] Copied {next_file} to clipboard.")
+
+            # Open browser
+            # webbrowser.open("https://datalab.noirlab.edu/legacy/query.php")
+            webbrowser.open("https://datalab.noirlab.edu/data-explorer")
+            print("[INFO] Opened NOIRLab Data Explorer.")
+            print("[HELP] Paste the query manually into the ADQL field (Ctrl+V / Cmd+V). Then click 'Execute'.")
+
+            # Copy .csv base file name (and directory) to clipboard
+            wait_for_key("[WAIT] Press [space] after you've pasted the query and selected 'Virtual Storage (VOS)' to get your .csv base filename: ", valid_keys=[' '])
+            print("[HELP] Click \"Virtual Storage (VOS)\" in the drop-down to see the \"File Name\" field.")
+            print("[INFO] Filename for CSV export: '{0}'".format(base_filename))
+            copy_to_clipboard(base_filename)
+            print("[CLIPBOARD] Copied CSV filename to clipboard.")
+
+            # Submit the query
+            wait_for_key("[WAIT] Press [Enter] after you've submitted the query (hit 'Save to VOS') to submit the query... ", valid_keys=['\r'])
         
-        # Rename the file to mark as done
-        done_path = os.path.join(directory, "DONE_" + next_file)
-        os.rename(filepath, done_path)
+            # Rename the file to mark as done
+            query_path.replace(query_dir / ("DONE_" + next_file))
 
-        # Log it
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with open(log_file, "a") as log:
+            # Log it (flushed right away so the log always matches the DONE_ files)
+            timestamp = datetime.now().isoformat(sep=" ", timespec="seconds")
             log.write(f"{next_file}\texecuted\t{timestamp}\n")
+            log.flush()
 
-        print(f"[OK] Logged and marked as done: {next_file}")
+            print(f"[OK] Logged and marked as done: {next_file}")
 
     print("\n[OK] All ADQL queries processed and logged.")
 